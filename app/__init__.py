@@ -6,6 +6,7 @@ from flask_login import LoginManager
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
+from app.compression import CompressionMiddleware
 import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
@@ -23,6 +24,14 @@ login.login_view = 'login'
 mail = Mail(app)
 bootstrap = Bootstrap(app)
 moment = Moment(app)
+# gzip/brotli compress responses before they leave the app
+app.wsgi_app = CompressionMiddleware(app.wsgi_app,
+                                     min_size=app.config['COMPRESS_MIN_SIZE'],
+                                     level=app.config['COMPRESS_LEVEL'],
+                                     cache_size=app.config['COMPRESS_CACHE_SIZE'],
+                                     cache_prefixes=(app.static_url_path + '/',),
+                                     report_every=app.config['COMPRESS_REPORT_EVERY'],
+                                     logger=app.logger)
 
 if not app.debug:
     # log errors by email
@@ -54,4 +63,4 @@ if not app.debug:
     app.logger.setLevel(logging.INFO)
     app.logger.info('Microblog startup')
 
-from app import routes, models, errors
\ No newline at end of file
+from app import routes, models, errors, assets
\ No newline at end of file
@@ -0,0 +1,294 @@
+import copy
+import gzip
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import lru_cache
+from threading import Lock
+
+import click
+import sqlalchemy as sa
+from app import app, db, sharding
+from app.models import Post
+from app.page_cache import explore_cache
+
+# fcntl is POSIX only, Windows locks the file with msvcrt instead
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# Archive of cold posts. Posts older than ARCHIVE_AFTER_DAYS are moved out of the post table
+# (or the shards) into one gzipped JSON lines segment per month in ARCHIVE_DIR, next to a small
+# index.json holding each segment's post count per user. The feeds use the index to skip whole
+# segments and only decompress the one a page actually lands in (see feeds.py).
+#
+# Feed requests read without taking the archive lock. The index records how many bytes of each
+# segment it covers and readers stop there, so rows being appended are not seen before the index
+# counts them. compact() writes each segment to a new file instead of rewriting it in place.
+#
+#   flask archive run                      # move old posts into the archive
+#   flask archive compact --interval 3600  # keep segments compacted in the background
+
+INDEX_NAME = 'index.json'
+LOCK_NAME = 'archive.lock'
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+# decoded segments, newest post first. Segment files only ever grow and the index records their
+# size, so path and size identify what was read
+@lru_cache(maxsize=8)
+def load_segment(path, size):
+    rows = list(read_rows(path, size))
+    rows.sort(key=lambda row: row['timestamp'], reverse=True)
+    return tuple(rows)
+
+
+# the rows in the first 'size' bytes of a segment (or the whole file if size is None)
+def read_rows(path, size=None):
+    with open(path, 'rb') as f:
+        data = f.read() if size is None else f.read(size)
+    for line in gzip.decompress(data).decode('utf-8').splitlines():
+        yield json.loads(line)
+
+
+def segment_name(month):
+    return f'posts-{month}-{uuid.uuid4().hex[:8]}.jsonl.gz'
+
+
+def serialize(row):
+    return {'id': row.id, 'body': row.body, 'timestamp': row.timestamp.strftime(TIMESTAMP_FORMAT),
+            'user_id': row.user_id}
+
+
+def new_entry(filename):
+    return {'file': filename, 'size': 0, 'count': 0, 'users': {}, 'oldest': None, 'newest': None}
+
+
+def add_to_entry(entry, row):
+    entry['count'] += 1
+    user = str(row['user_id'])
+    entry['users'][user] = entry['users'].get(user, 0) + 1
+    if entry['oldest'] is None or row['timestamp'] < entry['oldest']:
+        entry['oldest'] = row['timestamp']
+    if entry['newest'] is None or row['timestamp'] > entry['newest']:
+        entry['newest'] = row['timestamp']
+
+
+class PostArchive(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = Lock()
+        self._index = {}
+        self._index_version = None
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    # held while segments or the index are written. 'archive run' and 'archive compact' are
+    # separate processes, so besides the thread lock this takes a lock on a file in the archive
+    # directory: otherwise compact() could replace a segment with a copy missing the rows an
+    # append() added meanwhile, after they were already deleted from the database
+    @contextmanager
+    def locked(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock, open(self.path(LOCK_NAME), 'a+b') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    # segment entries keyed by month ('2023-05'), reloaded whenever another process updates them
+    def index(self):
+        try:
+            version = self.index_version()
+        except FileNotFoundError:
+            return {}
+        if version != self._index_version:
+            with open(self.path(INDEX_NAME)) as f:
+                self._index = json.load(f)
+            self._index_version = version
+        return self._index
+
+    def index_version(self):
+        stat = os.stat(self.path(INDEX_NAME))
+        return stat.st_mtime_ns, stat.st_size
+
+    def write_index(self, index):
+        tmp = self.path(INDEX_NAME + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(index, f, sort_keys=True)
+        os.replace(tmp, self.path(INDEX_NAME))
+        self._index = index
+        self._index_version = self.index_version()
+
+    def has_posts(self):
+        return bool(self.index())
+
+    @staticmethod
+    def segment_count(entry, user_ids):
+        if user_ids is None:
+            return entry['count']
+        return sum(entry['users'].get(str(user_id), 0) for user_id in user_ids)
+
+    # number of archived posts by the given users (or by everyone if user_ids is None)
+    def count(self, user_ids=None):
+        return sum(self.segment_count(entry, user_ids) for entry in self.index().values())
+
+    def read_segment(self, entry):
+        return load_segment(self.path(entry['file']), entry['size'])
+
+    # up to 'limit' archived posts by the given users, newest first, skipping the first 'offset'.
+    # Segments before the offset are skipped using the counts in the index without being read
+    def posts(self, user_ids, offset, limit):
+        try:
+            return self.read_posts(user_ids, offset, limit)
+        except FileNotFoundError:
+            # compact() replaced a segment after the index was read, the new index names its copy
+            return self.read_posts(user_ids, offset, limit)
+
+    def read_posts(self, user_ids, offset, limit):
+        wanted = None if user_ids is None else set(user_ids)
+        posts = []
+        for month, entry in sorted(self.index().items(), reverse=True):
+            count = self.segment_count(entry, user_ids)
+            if offset >= count:
+                offset -= count
+                continue
+            rows = [row for row in self.read_segment(entry) if wanted is None or row['user_id'] in wanted]
+            for row in rows[offset:offset + limit - len(posts)]:
+                posts.append(Post(id=row['id'], body=row['body'], user_id=row['user_id'],
+                                  timestamp=datetime.strptime(row['timestamp'], TIMESTAMP_FORMAT)))
+            offset = 0
+            if len(posts) >= limit:
+                break
+        return posts
+
+    # adds database rows to their month's segment. Each call appends a new gzip member to the
+    # segment file, leaving what is already there untouched - compact() merges them later.
+    # Readers only see the new rows once the index has been written with the new size
+    def append(self, rows):
+        months = {}
+        for row in rows:
+            months.setdefault(row.timestamp.strftime('%Y-%m'), []).append(serialize(row))
+        with self.locked():
+            index = copy.deepcopy(self.index())
+            for month, month_rows in months.items():
+                entry = index.get(month) or new_entry(segment_name(month))
+                with open(self.path(entry['file']), 'ab') as raw:
+                    # drop anything an interrupted append left past what the index covers
+                    raw.truncate(entry['size'])
+                    with gzip.GzipFile(fileobj=raw, mode='ab') as f:
+                        f.write(''.join(json.dumps(row) + '\n' for row in month_rows).encode('utf-8'))
+                    # the rows are deleted from the database next, so make sure they are on disk
+                    raw.flush()
+                    os.fsync(raw.fileno())
+                    entry['size'] = raw.tell()
+                for row in month_rows:
+                    add_to_entry(entry, row)
+                index[month] = entry
+            self.write_index(index)
+
+    # rewrites every segment as a single gzip member sorted newest first, dropping posts archived
+    # twice by an interrupted 'archive run', and rebuilds the index from what is left. Each
+    # segment is written to a new file, and the old ones are only removed once the new index
+    # is in place. Returns the number of duplicates removed
+    def compact(self):
+        removed = 0
+        with self.locked():
+            index = {}
+            replaced = []
+            for month, entry in sorted(self.index().items()):
+                seen = set()
+                rows = []
+                for row in read_rows(self.path(entry['file']), entry['size']):
+                    key = (row['id'], row['user_id'], row['timestamp'])
+                    if key in seen:
+                        removed += 1
+                        continue
+                    seen.add(key)
+                    rows.append(row)
+                rows.sort(key=lambda row: row['timestamp'], reverse=True)
+
+                index[month] = new_entry(segment_name(month))
+                with open(self.path(index[month]['file']), 'wb') as raw:
+                    with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=9) as f:
+                        f.write(''.join(json.dumps(row) + '\n' for row in rows).encode('utf-8'))
+                    raw.flush()
+                    os.fsync(raw.fileno())
+                    index[month]['size'] = raw.tell()
+                for row in rows:
+                    add_to_entry(index[month], row)
+                replaced.append(entry['file'])
+            self.write_index(index)
+            for filename in replaced:
+                os.remove(self.path(filename))
+        return removed
+
+
+archive = PostArchive(app.config['ARCHIVE_DIR'])
+
+
+# Moves posts older than 'cutoff' from the database (or every shard) into the archive,
+# batch_size posts at a time. Returns the number of posts archived.
+def archive_posts(cutoff, batch_size=1000):
+    if sharding.shards.enabled:
+        sources = [(engine, sharding.shard_post_table) for engine in sharding.shards.engines]
+    else:
+        sources = [(db.engine, Post.__table__)]
+    archived = 0
+    for engine, table in sources:
+        old_posts = sa.select(table).where(table.c.timestamp < cutoff).order_by(table.c.timestamp).limit(batch_size)
+        while True:
+            with engine.connect() as connection:
+                rows = connection.execute(old_posts).all()
+            if not rows:
+                break
+            archive.append(rows)
+            with engine.begin() as connection:
+                connection.execute(table.delete().where(table.c.id.in_([row.id for row in rows])))
+            archived += len(rows)
+    # bulk deletes don't trigger the events page_cache.py listens for
+    if archived:
+        explore_cache.bump()
+    return archived
+
+
+@app.cli.group('archive')
+def archive_cli():
+    """Archive old posts into compressed monthly segments."""
+
+
+@archive_cli.command('run')
+@click.option('--days', type=int, default=None, help='Archive posts older than this. Defaults to ARCHIVE_AFTER_DAYS.')
+@click.option('--batch-size', default=1000, show_default=True)
+def run_command(days, batch_size):
+    """Move old posts into the archive."""
+    days = days if days is not None else app.config['ARCHIVE_AFTER_DAYS']
+    archived = archive_posts(datetime.utcnow() - timedelta(days=days), batch_size=batch_size)
+    click.echo(f'Archived {archived} posts older than {days} days.')
+
+
+@archive_cli.command('compact')
+@click.option('--interval', type=float, default=None, help='Keep running, compacting every INTERVAL seconds.')
+def compact_command(interval):
+    """Merge and deduplicate archive segments."""
+    while True:
+        removed = archive.compact()
+        click.echo(f'Compacted {len(archive.index())} segments, removed {removed} duplicate posts.')
+        if interval is None:
+            break
+        time.sleep(interval)
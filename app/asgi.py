@@ -0,0 +1,227 @@
+import io
+import sys
+from datetime import datetime
+
+from flask import render_template, request, session, url_for, g, abort
+from markupsafe import Markup
+from sqlalchemy import select, func, or_
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker, selectinload, configure_mappers
+from asgiref.wsgi import WsgiToAsgi
+from app import app
+from app.forms import PostForm, EmptyForm
+from app.models import User, Post, followers
+from app.page_cache import explore_cache
+from app.sharding import shards
+from app.archive import archive
+
+# Opt-in ASGI mode (see microblog_asgi.py). GET requests for the read-heavy feed pages are served
+# here with an async engine, so a slow feed query no longer holds a worker thread for its whole
+# duration. Everything else - forms, logins, the remember-me cookie - is passed to the normal
+# WSGI app through asgiref's adapter.
+
+# the async views must read the same database as the rest of the app
+def same_database(url, other):
+    url, other = make_url(url), make_url(other)
+    return (url.host, url.port, url.database) == (other.host, other.port, other.database)
+
+
+if not same_database(app.config['ASYNC_DATABASE_URL'], app.config['SQLALCHEMY_DATABASE_URI']):
+    raise RuntimeError('ASYNC_DATABASE_URL points to a different database than DATABASE_URL.')
+
+engine = create_async_engine(app.config['ASYNC_DATABASE_URL'])
+async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+# relationship backrefs such as Post.author only exist once the mappers are configured
+configure_mappers()
+
+
+# raised when a page runs past the posts in the database, as the async views don't read the archive
+class ReadsArchive(Exception):
+    pass
+
+
+# fetch one page of posts with their authors. One extra post is requested to find out whether
+# there is a next page, which saves the count query that paginate() runs
+async def fetch_page(db_session, query, page, per_page):
+    query = query.options(selectinload(Post.author)).limit(per_page + 1).offset((page - 1) * per_page)
+    posts = (await db_session.execute(query)).scalars().all()
+    if len(posts) <= per_page and archive.has_posts():
+        raise ReadsArchive()
+    return posts[:per_page], len(posts) > per_page
+
+
+# the requested page number. Like paginate(error_out=False) in the WSGI views, pages before
+# the first are treated as page 1
+def page_arg():
+    return max(request.args.get(key='page', default=1, type=int), 1)
+
+
+def page_urls(endpoint, page, has_next, **values):
+    next_url = url_for(endpoint, page=page + 1, **values) if has_next else None
+    prev_url = url_for(endpoint, page=page - 1, **values) if page > 1 else None
+    return next_url, prev_url
+
+
+async def count(db_session, query):
+    return (await db_session.execute(select(func.count()).select_from(query.subquery()))).scalar()
+
+
+async def index(db_session, current):
+    page = page_arg()
+    # same posts as User.followed_posts(): the user's own plus those of everyone they follow
+    followed_ids = select(followers.c.followed_id).where(followers.c.follower_id == current.id)
+    query = select(Post).where(or_(Post.user_id.in_(followed_ids), Post.user_id == current.id)) \
+        .order_by(Post.timestamp.desc())
+    posts, has_next = await fetch_page(db_session, query, page, app.config['POSTS_PER_PAGE'])
+    next_url, prev_url = page_urls('index', page, has_next)
+    return render_template('index.html', title='Home', form=PostForm(), posts=posts,
+                           next_url=next_url, prev_url=prev_url)
+
+
+async def explore(db_session, current):
+    page = page_arg()
+    version, post_list = explore_cache.lookup(page)
+    if post_list is None:
+        query = select(Post).order_by(Post.timestamp.desc())
+        posts, has_next = await fetch_page(db_session, query, page, app.config['POSTS_PER_PAGE'])
+        next_url, prev_url = page_urls('explore', page, has_next)
+        post_list = Markup(render_template('_post_list.html', posts=posts, next_url=next_url, prev_url=prev_url))
+        explore_cache.store(version, page, post_list)
+    return render_template('index.html', title='Explore', post_list=post_list)
+
+
+async def user(db_session, current, username):
+    profile = (await db_session.execute(select(User).where(User.username == username))).scalar()
+    if profile is None:
+        abort(404)
+    page = page_arg()
+    query = select(Post).where(Post.user_id == profile.id).order_by(Post.timestamp.desc())
+    posts, has_next = await fetch_page(db_session, query, page, app.config['POSTS_PER_PAGE'])
+    next_url, prev_url = page_urls('user', page, has_next, username=username)
+    followers_count = await count(db_session, select(followers).where(followers.c.followed_id == profile.id))
+    followed_count = await count(db_session, select(followers).where(followers.c.follower_id == profile.id))
+    is_following = await count(db_session, select(followers).where(
+        followers.c.follower_id == current.id, followers.c.followed_id == profile.id)) > 0
+    return render_template('user.html', user=profile, posts=posts, form=EmptyForm(),
+                           next_url=next_url, prev_url=prev_url, followers_count=followers_count,
+                           followed_count=followed_count, is_following=is_following)
+
+
+# endpoints served asynchronously for GET requests
+ASYNC_VIEWS = {'index': index, 'explore': explore, 'user': user}
+
+
+# build the WSGI environ Flask needs for its request context from an ASGI 'http' scope
+def build_environ(scope):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+    return environ
+
+
+class AsyncFeedApp(object):
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http' or scope['method'] != 'GET':
+            return await self.wsgi(scope, receive, send)
+
+        environ = build_environ(scope)
+        # the WSGI app is wrapped in CompressionMiddleware (see __init__.py), which the async
+        # responses have to go through as well
+        compression = self.flask_app.wsgi_app
+        negotiated = compression.prepare(environ)
+        ctx = self.flask_app.request_context(environ)
+        ctx.push()
+        try:
+            try:
+                response = await self.dispatch()
+            except Exception as e:
+                # same as Flask.wsgi_app: logs the error and renders the 500 handler in errors.py
+                response = self.flask_app.handle_exception(e)
+            if response is not None:
+                captured = {}
+
+                def start_response(status, headers, exc_info=None):
+                    captured['status'] = int(status.split(' ', 1)[0])
+                    captured['headers'] = headers
+
+                body = b''.join(compression.respond(response, environ, start_response, *negotiated))
+        finally:
+            ctx.pop()
+
+        if response is None:
+            return await self.wsgi(scope, receive, send)
+        await send({'type': 'http.response.start', 'status': captured['status'],
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                for name, value in captured['headers']]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    # returns the response of an async view, or None if the request should go to the WSGI app
+    async def dispatch(self):
+        view = ASYNC_VIEWS.get(request.endpoint)
+        # requests without a logged-in session (including remember-me logins) take the normal
+        # route so flask_login can redirect or restore them
+        user_id = session.get('_user_id')
+        # the async views only read the main database, so sharded posts are served by the WSGI app
+        if view is None or user_id is None or shards.enabled:
+            return None
+        async with async_session() as db_session:
+            current = await db_session.get(User, int(user_id))
+            if current is None:
+                return None
+            # same as before_request() in routes.py
+            current.last_seen = datetime.utcnow()
+            await db_session.commit()
+            # flask_login looks here first, so current_user is the user loaded above
+            g._login_user = current
+            try:
+                rv = await view(db_session, current, **request.view_args)
+            except ReadsArchive:
+                # feeds.py carries on into the archive
+                return None
+            except Exception as e:
+                # HTTP errors such as abort(404) get their error page, anything else is re-raised
+                rv = self.flask_app.handle_user_exception(e)
+        # runs the after_request hooks (Cache-Control, ETags) and saves the session cookie
+        return self.flask_app.process_response(self.flask_app.make_response(rv))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+application = AsyncFeedApp(app)
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import re
+from io import BytesIO
+
+import click
+from flask import send_from_directory, url_for, abort
+from app import app
+
+# original, full-size images committed to the repo
+IMAGE_SOURCE_DIR = os.path.join(app.root_path, 'images')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+MANIFEST_NAME = 'manifest.json'
+
+# the manifest is read once per process and read again whenever 'flask build-images' rewrites it
+_manifest = None
+_manifest_version = None
+
+
+def manifest_path():
+    return os.path.join(app.config['IMAGE_BUILD_DIR'], MANIFEST_NAME)
+
+
+# returns the mapping of original filename -> generated variants, or an empty dict if
+# 'flask build-images' has not been run yet. The missing file is not cached, so a running
+# server picks up the variants as soon as they are built
+def load_manifest():
+    global _manifest, _manifest_version
+    try:
+        stat = os.stat(manifest_path())
+    except FileNotFoundError:
+        return {}
+    version = (stat.st_mtime_ns, stat.st_size)
+    if _manifest is None or version != _manifest_version:
+        with open(manifest_path()) as f:
+            _manifest = json.load(f)
+        _manifest_version = version
+    return _manifest
+
+
+def reset_manifest():
+    global _manifest
+    _manifest = None
+
+
+# widths to generate for an image, never upscaling past the original width
+def target_widths(original_width, widths):
+    targets = sorted(w for w in widths if w < original_width)
+    targets.append(original_width)
+    return targets
+
+
+# name variants after the content hash so they can be cached forever - a new image
+# means a new url
+def hashed_name(filename, width, fmt, data):
+    stem = os.path.splitext(filename)[0]
+    slug = re.sub(r'[^a-z0-9]+', '-', stem.lower()).strip('-')
+    digest = hashlib.sha256(data).hexdigest()[:10]
+    return f'{slug}-{width}.{digest}.{fmt}'
+
+
+def encode_image(image, width, fmt, quality):
+    from PIL import Image
+
+    if width != image.width:
+        height = round(image.height * width / image.width)
+        image = image.resize((width, height), Image.LANCZOS)
+    buffer = BytesIO()
+    if fmt == 'webp':
+        image.save(buffer, format='WEBP', quality=quality, method=6)
+    else:
+        image.save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def build_images(source_dir, build_dir, widths, formats, quality):
+    # Pillow is only needed when building, not when serving the generated files
+    from PIL import Image
+
+    os.makedirs(build_dir, exist_ok=True)
+    manifest = {}
+    for filename in sorted(os.listdir(source_dir)):
+        path = os.path.join(source_dir, filename)
+        if not os.path.isfile(path) or not filename.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        with Image.open(path) as original:
+            mode = 'RGBA' if 'A' in original.getbands() or 'transparency' in original.info else 'RGB'
+            image = original.convert(mode)
+        variants = {}
+        for fmt in formats:
+            variants[fmt] = {}
+            for width in target_widths(image.width, widths):
+                data = encode_image(image, width, fmt, quality)
+                name = hashed_name(filename, width, fmt, data)
+                output = os.path.join(build_dir, name)
+                if not os.path.exists(output):
+                    with open(output, 'wb') as f:
+                        f.write(data)
+                variants[fmt][str(width)] = name
+        manifest[filename] = {'width': image.width, 'height': image.height, 'variants': variants}
+
+    with open(os.path.join(build_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    reset_manifest()
+    return manifest
+
+
+# returns the url of the smallest variant at least 'width' pixels wide (or the largest
+# variant if none are wide enough). Falls back to the original file if it has not been built.
+@app.template_global()
+def image_url(filename, width=None, fmt='png'):
+    entry = load_manifest().get(filename)
+    if entry is None:
+        return url_for('image', filename=filename)
+    variants = entry['variants'].get(fmt) or next(iter(entry['variants'].values()))
+    widths = sorted(int(w) for w in variants)
+    chosen = next((w for w in widths if width is not None and w >= width), widths[-1])
+    return url_for('image', filename=variants[str(chosen)])
+
+
+# returns a 'srcset' attribute value listing every width generated for the image, e.g.
+# <img src="{{ image_url('HSE Polar Icon.png', 320) }}" srcset="{{ image_srcset('HSE Polar Icon.png') }}">
+@app.template_global()
+def image_srcset(filename, fmt='webp'):
+    entry = load_manifest().get(filename)
+    if entry is None or fmt not in entry['variants']:
+        return ''
+    variants = entry['variants'][fmt]
+    return ', '.join(f"{url_for('image', filename=variants[w])} {w}w"
+                     for w in sorted(variants, key=int))
+
+
+@app.route('/images/<path:filename>')
+def image(filename):
+    built = {name for entry in load_manifest().values()
+             for variants in entry['variants'].values() for name in variants.values()}
+    if filename in built:
+        response = send_from_directory(app.config['IMAGE_BUILD_DIR'], filename)
+        # content-hashed names never change, so browsers and proxies can keep them forever
+        response.headers['Cache-Control'] = f"public, max-age={app.config['IMAGE_CACHE_MAX_AGE']}, immutable"
+        return response
+    # only serve originals from the top level of the source directory
+    if os.path.dirname(filename):
+        abort(404)
+    return send_from_directory(IMAGE_SOURCE_DIR, filename)
+
+
+@app.cli.command('build-images')
+def build_images_command():
+    """Generate resized, content-hashed variants of app/images."""
+    manifest = build_images(IMAGE_SOURCE_DIR, app.config['IMAGE_BUILD_DIR'],
+                            app.config['IMAGE_WIDTHS'], app.config['IMAGE_FORMATS'],
+                            app.config['IMAGE_QUALITY'])
+    for filename, entry in manifest.items():
+        for fmt, variants in entry['variants'].items():
+            click.echo(f'{filename} [{fmt}]: ' + ', '.join(f'{w}w' for w in sorted(variants, key=int)))
@@ -0,0 +1,176 @@
+import gzip
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+from werkzeug.http import parse_accept_header
+
+# brotli is optional - without it responses are only ever gzipped
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml',
+                      'image/svg+xml')
+
+
+# WSGI middleware that gzip/brotli compresses responses according to the client's
+# Accept-Encoding header. Compressed bodies of static content are kept in a small LRU cache
+# keyed by path, ETag and encoding so they are only compressed once. The bytes saved so far are
+# logged at INFO level every report_every compressed responses.
+class CompressionMiddleware(object):
+    def __init__(self, app, min_size=500, level=6, cache_size=128, cache_prefixes=('/static/',),
+                 report_every=1000, logger=None):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.cache_size = cache_size
+        self.cache_prefixes = tuple(cache_prefixes)
+        self.report_every = report_every
+        self.logger = logger or logging.getLogger(__name__)
+        self.cache = OrderedDict()
+        self.lock = Lock()
+        # running totals, used to report how much compression is saving
+        self.responses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def bytes_saved(self):
+        return self.bytes_in - self.bytes_out
+
+    # pick the best encoding the client accepts, preferring brotli over gzip
+    def negotiate(self, accept_encoding):
+        accept = parse_accept_header(accept_encoding)
+        encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+        quality, encoding = max(((accept.quality(e), e) for e in encodings), key=lambda qe: qe[0])
+        return encoding if quality > 0 else None
+
+    def compress(self, body, encoding):
+        if encoding == 'br':
+            return brotli.compress(body, quality=min(self.level, 11))
+        return gzip.compress(body, compresslevel=self.level)
+
+    def __call__(self, environ, start_response):
+        encoding, revalidating_encoded = self.prepare(environ)
+        return self.respond(self.app, environ, start_response, encoding, revalidating_encoded)
+
+    # picks the encoding for the request and returns it with whether the client is revalidating
+    # a compressed entity. Must run before the app sees environ: clients revalidate with the ETag
+    # of the compressed entity, so the encoding suffix is stripped again before the app compares
+    # it with its own
+    def prepare(self, environ):
+        encoding = self.negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        revalidating_encoded = False
+        if encoding is not None and 'HTTP_IF_NONE_MATCH' in environ:
+            if_none_match = environ['HTTP_IF_NONE_MATCH']
+            environ['HTTP_IF_NONE_MATCH'] = if_none_match.replace(f'-{encoding}"', '"')
+            revalidating_encoded = environ['HTTP_IF_NONE_MATCH'] != if_none_match
+        return encoding, revalidating_encoded
+
+    # calls 'app' (the wrapped app, or a response object as asgi.py passes) and compresses what
+    # it returns. environ must have been through prepare() first
+    def respond(self, app, environ, start_response, encoding, revalidating_encoded):
+        captured = {}
+
+        def capture_start_response(status, headers, exc_info=None):
+            captured['status'] = status
+            captured['headers'] = headers
+            captured['exc_info'] = exc_info
+
+        app_iter = app(environ, capture_start_response)
+        status, headers = captured['status'], captured['headers']
+        header_names = {name.lower(): value for name, value in headers}
+        content_type = header_names.get('content-type', '')
+
+        if revalidating_encoded and status.startswith('304'):
+            headers = [(name, self.encoded_etag(value, encoding) if name.lower() == 'etag' else value)
+                       for name, value in headers]
+
+        # leave alone anything that is already encoded, streamed or not worth compressing. Streamed
+        # responses (e.g. text/event-stream) have no Content-Length, and compressing them would
+        # hold every chunk back until the stream ends
+        if (not content_type.startswith(COMPRESSIBLE_TYPES) or 'content-encoding' in header_names
+                or 'content-length' not in header_names
+                or environ['REQUEST_METHOD'] == 'HEAD' or not status.startswith('200')):
+            start_response(status, headers, captured['exc_info'])
+            return app_iter
+
+        # caches must store a separate copy of compressible responses for each encoding
+        headers = self.add_vary(headers)
+        cache_key = None
+        if encoding is not None and 'etag' in header_names \
+                and environ.get('PATH_INFO', '').startswith(self.cache_prefixes):
+            cache_key = (environ['PATH_INFO'], header_names['etag'], encoding)
+            with self.lock:
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    self.cache.move_to_end(cache_key)
+            if cached is not None:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+                compressed, uncompressed_size = cached
+                return self.send_compressed(start_response, status, headers, compressed,
+                                            encoding, uncompressed_size)
+
+        try:
+            body = b''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+        if encoding is None or len(body) < self.min_size:
+            start_response(status, headers, captured['exc_info'])
+            return [body]
+
+        compressed = self.compress(body, encoding)
+        if cache_key is not None:
+            with self.lock:
+                self.cache[cache_key] = (compressed, len(body))
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return self.send_compressed(start_response, status, headers, compressed, encoding,
+                                    uncompressed_size=len(body))
+
+    def send_compressed(self, start_response, status, headers, compressed, encoding, uncompressed_size):
+        with self.lock:
+            self.responses += 1
+            self.bytes_in += uncompressed_size
+            self.bytes_out += len(compressed)
+            report = self.report_every and self.responses % self.report_every == 0
+        self.logger.debug(f'Compressed response with {encoding}: {uncompressed_size} -> '
+                          f'{len(compressed)} bytes')
+        if report:
+            self.logger.info(f'Compression saved {self.bytes_saved} bytes over {self.responses} '
+                             f'responses ({self.bytes_in} -> {self.bytes_out} bytes)')
+        new_headers = []
+        for name, value in headers:
+            lower = name.lower()
+            if lower == 'content-length':
+                continue
+            if lower == 'etag':
+                # the compressed representation is a different entity from the uncompressed one
+                value = self.encoded_etag(value, encoding)
+            new_headers.append((name, value))
+        new_headers.append(('Content-Encoding', encoding))
+        new_headers.append(('Content-Length', str(len(compressed))))
+        start_response(status, new_headers)
+        return [compressed]
+
+    @staticmethod
+    def encoded_etag(etag, encoding):
+        if etag.endswith('"'):
+            return f'{etag[:-1]}-{encoding}"'
+        return etag
+
+    @staticmethod
+    def add_vary(headers):
+        for index, (name, value) in enumerate(headers):
+            if name.lower() == 'vary':
+                varies = [v.strip() for v in value.split(',')]
+                if 'accept-encoding' not in (v.lower() for v in varies) and '*' not in varies:
+                    headers = list(headers)
+                    headers[index] = (name, f'{value}, Accept-Encoding')
+                return headers
+        return list(headers) + [('Vary', 'Accept-Encoding')]
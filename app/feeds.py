@@ -0,0 +1,63 @@
+from app import db, sharding
+from app.archive import archive
+from app.models import Post, followers
+
+# The views read and write posts through these functions, which hide whether posts are sharded
+# (see sharding.py) and carry on into the archive of old posts once a feed runs past the posts
+# still in the database (see archive.py).
+
+
+def add_post(body, author):
+    if sharding.shards.enabled:
+        sharding.shards.add(Post(body=body, user_id=author.id))
+    else:
+        db.session.add(Post(body=body, author=author))
+        db.session.commit()
+
+
+def followed_ids(user):
+    followed = db.session.query(followers.c.followed_id).filter(followers.c.follower_id == user.id)
+    return [user.id] + [user_id for user_id, in followed]
+
+
+def user_posts_page(user, page, per_page):
+    if sharding.shards.enabled:
+        hot = sharding.shards.paginate([user.id], page, per_page)
+    else:
+        hot = user.posts.order_by(Post.timestamp.desc()).paginate(page=page, per_page=per_page, error_out=False)
+    return read_through(hot, [user.id], page, per_page)
+
+
+def followed_posts_page(user, page, per_page):
+    if sharding.shards.enabled:
+        hot = sharding.shards.paginate(followed_ids(user), page, per_page)
+    else:
+        hot = user.followed_posts().paginate(page=page, per_page=per_page, error_out=False)
+    return read_through(hot, lambda: followed_ids(user), page, per_page)
+
+
+def all_posts_page(page, per_page):
+    if sharding.shards.enabled:
+        hot = sharding.shards.paginate(None, page, per_page)
+    else:
+        hot = Post.query.order_by(Post.timestamp.desc()).paginate(page=page, per_page=per_page, error_out=False)
+    return read_through(hot, None, page, per_page)
+
+
+# Fills a page that runs past the posts in the database with the newest archived posts. Every
+# archived post is older than every post left in the database, so the archive simply continues
+# where the database stops. user_ids may be a function, so the followed users are only looked
+# up when there is an archive.
+def read_through(hot, user_ids, page, per_page):
+    if not archive.has_posts():
+        return hot
+    if callable(user_ids):
+        user_ids = user_ids()
+    # the page number as clamped by paginate()
+    page = hot.page
+    items = list(hot.items)
+    if len(items) < per_page:
+        archived = archive.posts(user_ids, max(0, (page - 1) * per_page - hot.total), per_page - len(items))
+        sharding.attach_authors(archived)
+        items += archived
+    return sharding.PostPage(items, page, per_page, hot.total + archive.count(user_ids))
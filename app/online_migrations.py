@@ -0,0 +1,130 @@
+import time
+from datetime import datetime
+
+import sqlalchemy as sa
+from alembic import op
+from flask import current_app
+
+# Helpers for changing the schema of large tables without holding one long write lock, for use
+# inside migration scripts, e.g.
+#
+#   from app.online_migrations import add_column, backfill, create_index
+#
+#   def upgrade():
+#       add_column('post', sa.Column('language', sa.String(5)))
+#       backfill('post', {'language': 'en'}, where=sa.text('language IS NULL'))
+#       create_index('ix_post_language', 'post', ['language'])
+#
+# Unlike batch_alter_table, none of them copy the table on SQLite. backfill() and create_index()
+# commit as they go, so a revision using them should only contain changes that are safe to apply
+# in steps (env.py runs each revision in its own transaction). If such a revision is interrupted,
+# running it again skips the columns already added and resumes the backfill from its checkpoint.
+
+# one row per backfill, recording the last primary key processed so an interrupted backfill
+# carries on where it stopped instead of starting again
+checkpoints = sa.Table(
+    'migration_checkpoint', sa.MetaData(),
+    sa.Column('name', sa.String(128), primary_key=True),
+    sa.Column('last_id', sa.Integer, nullable=False),
+    sa.Column('rows', sa.Integer, nullable=False),
+    sa.Column('updated_at', sa.DateTime, nullable=False),
+)
+
+
+def config_value(key, default):
+    try:
+        return current_app.config.get(key, default)
+    except RuntimeError:
+        # running outside of the flask app, e.g. from a benchmark
+        return default
+
+
+def add_column(table, column):
+    # a backfill() later in the revision commits the column before the revision completes, so
+    # when an interrupted revision is run again the column may already be there
+    if column.name in {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}:
+        return
+    # ALTER TABLE ... ADD COLUMN never rewrites the table, unlike batch_alter_table on SQLite
+    op.add_column(table, column)
+
+
+def create_index(name, table, columns, unique=False):
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        # CONCURRENTLY cannot run inside a transaction
+        with op.get_context().autocommit_block():
+            op.create_index(name, table, columns, unique=unique, postgresql_concurrently=True)
+    elif dialect == 'mysql':
+        op.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX {name} ON {table} "
+                   f"({', '.join(columns)}) ALGORITHM=INPLACE LOCK=NONE")
+    else:
+        # SQLite has no online index builds, but a plain CREATE INDEX is still far cheaper than
+        # the table copy batch_alter_table makes
+        op.create_index(name, table, columns, unique=unique)
+
+
+def drop_index(name, table):
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
+    else:
+        op.drop_index(name, table_name=table)
+
+
+# Sets 'values' on every row of 'table' matching 'where', batch_size rows at a time in order of
+# the 'id' primary key. Each batch commits on its own and is followed by a pause of 'throttle'
+# seconds, so other connections can write between batches. Progress is checkpointed under
+# 'checkpoint' (default: 'backfill_<table>') and picked up again if the migration is re-run.
+# A batch that was interrupted before its checkpoint is simply applied again, so 'values' must
+# be safe to set twice. Returns the number of rows updated.
+def backfill(table, values, where=None, batch_size=None, throttle=None, checkpoint=None, key='id'):
+    batch_size = batch_size or config_value('MIGRATION_BATCH_SIZE', 1000)
+    throttle = config_value('MIGRATION_BATCH_THROTTLE', 0) if throttle is None else throttle
+    checkpoint = checkpoint or f'backfill_{table}'
+    target = sa.table(table, sa.column(key), *(sa.column(name) for name in values))
+    key_column = target.c[key]
+
+    with op.get_context().autocommit_block():
+        # the block swaps in an autocommit connection, so it has to be fetched inside it
+        connection = op.get_bind()
+        checkpoints.create(connection, checkfirst=True)
+        row = connection.execute(sa.select(checkpoints.c.last_id, checkpoints.c.rows)
+                                 .where(checkpoints.c.name == checkpoint)).first()
+        resuming = row is not None
+        last_id, updated = (row.last_id, row.rows) if resuming else (None, 0)
+        max_id = connection.execute(sa.select(sa.func.max(key_column))).scalar()
+
+        while max_id is not None and (last_id is None or last_id < max_id):
+            # find where the next batch ends first, so the UPDATE is a bounded primary key range
+            ids = sa.select(key_column).order_by(key_column).limit(batch_size)
+            if last_id is not None:
+                ids = ids.where(key_column > last_id)
+            batch_end = connection.execute(sa.select(sa.func.max(ids.subquery().c[key]))).scalar()
+            if batch_end is None:
+                break
+
+            update = target.update().where(key_column <= batch_end).values(**values)
+            if last_id is not None:
+                update = update.where(key_column > last_id)
+            if where is not None:
+                update = update.where(where)
+            updated += connection.execute(update).rowcount
+            save_checkpoint(connection, checkpoint, batch_end, updated, resuming)
+            resuming = True
+            last_id = batch_end
+            if throttle:
+                time.sleep(throttle)
+
+        connection.execute(checkpoints.delete().where(checkpoints.c.name == checkpoint))
+        # the table only exists while a backfill is unfinished (env.py also hides it from autogenerate)
+        if connection.execute(sa.select(sa.func.count()).select_from(checkpoints)).scalar() == 0:
+            checkpoints.drop(connection)
+    return updated
+
+
+def save_checkpoint(connection, name, last_id, rows, exists):
+    values = {'last_id': last_id, 'rows': rows, 'updated_at': datetime.utcnow()}
+    if exists:
+        connection.execute(checkpoints.update().where(checkpoints.c.name == name).values(**values))
+    else:
+        connection.execute(checkpoints.insert().values(name=name, **values))
@@ -0,0 +1,118 @@
+import os
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+from app import app
+from app.models import User, Post
+
+
+# in-memory cache of rendered page fragments. Every entry is stored under the current version,
+# so bumping the version invalidates everything at once without having to know which keys exist.
+# The version is kept in version_file, so a bump by any worker process (or by a CLI command such as
+# 'flask archive run') invalidates the entries of every process sharing that file. Entries also
+# expire after ttl seconds, which bounds staleness where the file is not shared (e.g. across hosts)
+class PageCache(object):
+    def __init__(self, max_entries, version_file, ttl=None):
+        self.max_entries = max_entries
+        self.version_file = version_file
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # a random token rewritten by every bump, so concurrent bumps can't produce the same version
+    @property
+    def version(self):
+        try:
+            with open(self.version_file) as f:
+                return f.read()
+        except FileNotFoundError:
+            return ''
+
+    def get_or_render(self, key, render):
+        version, value = self.lookup(key)
+        if value is None:
+            value = render()
+            self.store(version, key, value)
+        return value
+
+    # returns the current version with the cached value (or None). Callers that render
+    # themselves must pass that version back to store(): if it was bumped while they rendered,
+    # the result is dropped instead of being cached as current
+    def lookup(self, key):
+        version = self.version
+        with self.lock:
+            entry = self.entries.get((version, key))
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+                del self.entries[(version, key)]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end((version, key))
+                self.hits += 1
+                return version, entry[1]
+            self.misses += 1
+            return version, None
+
+    def store(self, version, key, value):
+        if version != self.version:
+            return
+        with self.lock:
+            # drop whatever was cached under older versions
+            for stale in [k for k in self.entries if k[0] != version]:
+                del self.entries[stale]
+            self.entries[(version, key)] = (time.monotonic(), value)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def bump(self):
+        # a temp file of its own, as other threads and processes may be bumping at the same time
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.version_file) or None, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(uuid.uuid4().hex)
+        os.replace(tmp, self.version_file)
+        with self.lock:
+            self.entries.clear()
+
+
+# rendered post lists of the explore page, keyed by page number
+explore_cache = PageCache(max_entries=app.config['EXPLORE_CACHE_PAGES'],
+                          version_file=app.config['PAGE_CACHE_VERSION_FILE'],
+                          ttl=app.config['EXPLORE_CACHE_TTL'])
+
+
+# mark the session when a change affects the explore page. The cache is only invalidated once
+# the change is committed, otherwise a request could re-cache the page before the post is visible
+def mark_explore_changed(target):
+    session = object_session(target)
+    if session is not None:
+        session.info['explore_changed'] = True
+
+
+@event.listens_for(Post, 'after_insert')
+@event.listens_for(Post, 'after_delete')
+def post_changed(mapper, connection, target):
+    mark_explore_changed(target)
+
+
+# posts show the author's username, so renaming a user also changes the page
+@event.listens_for(User, 'after_update')
+def user_changed(mapper, connection, target):
+    if inspect(target).attrs.username.history.has_changes():
+        mark_explore_changed(target)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_explore(session):
+    if session.info.pop('explore_changed', False):
+        explore_cache.bump()
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_explore_changes(session):
+    session.info.pop('explore_changed', None)
@@ -2,10 +2,13 @@ from flask import render_template, flash, redirect, url_for, request
 from app import app, db
 from app.forms import LoginForm, RegistrationForm, EditProfileForm, EmptyForm, PostForm, ResetPasswordRequestForm
 from app.forms import ResetPasswordForm
-from app.models import User, Post
+from app.models import User
 from app.email import send_password_reset_email
+from app.page_cache import explore_cache
+from app.feeds import add_post, user_posts_page, followed_posts_page, all_posts_page
 from flask_login import current_user, login_user, logout_user, login_required
 from werkzeug.urls import url_parse
+from markupsafe import Markup
 from datetime import datetime
 
 
@@ -17,17 +20,14 @@ from datetime import datetime
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        post = Post(body=form.post.data, author=current_user)
-        db.session.add(post)
-        db.session.commit()
+        add_post(form.post.data, author=current_user)
         flash('Your post is now live!')
         return redirect(url_for('index'))
     page = request.args.get(key='page', default=1, type=int)
-    # Use pagination to return SQL-Alchemy 'Pagination' object, which has an 'items' method,
-    # which returns a list of items in the requested page.The number of items is defined in config.py
-    posts = current_user.followed_posts().paginate(
-        page=page, per_page=app.config['POSTS_PER_PAGE'], error_out=False
-    )
+    # Use pagination to return SQL-Alchemy 'Pagination' object (or a PostPage when posts are sharded or archived, see feeds.py),
+    # which has an 'items' method, which returns a list of items in the requested page.The number of items is defined
+    # in config.py
+    posts = followed_posts_page(current_user, page=page, per_page=app.config['POSTS_PER_PAGE'])
     next_url = url_for('index', page=posts.next_num) if posts.has_next else None
     prev_url = url_for('index', page=posts.prev_num) if posts.has_prev else None
     return render_template('index.html', title='Home', form=form, posts=posts.items,
@@ -40,12 +40,17 @@ def index():
 @login_required
 def explore():
     page = request.args.get(key='page', default=1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=app.config['POSTS_PER_PAGE'], error_out=False
-    )
+    # the post list is the same for every user, so it is rendered once per page and reused until a post
+    # is created (see page_cache.py). The header and flashed messages are still rendered for each request.
+    post_list = explore_cache.get_or_render(page, lambda: render_explore_posts(page))
+    return render_template('index.html', title='Explore', post_list=post_list)
+
+
+def render_explore_posts(page):
+    posts = all_posts_page(page=page, per_page=app.config['POSTS_PER_PAGE'])
     next_url = url_for('explore', page=posts.next_num) if posts.has_next else None
     prev_url = url_for('explore', page=posts.prev_num) if posts.has_prev else None
-    return render_template('index.html', title='Explore', posts=posts.items, next_url=next_url, prev_url=prev_url)
+    return Markup(render_template('_post_list.html', posts=posts.items, next_url=next_url, prev_url=prev_url))
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -135,13 +140,14 @@ def reset_password(token):
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
     page = request.args.get(key='page', default=1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=app.config['POSTS_PER_PAGE'], error_out=False
-    )
+    posts = user_posts_page(user, page=page, per_page=app.config['POSTS_PER_PAGE'])
     next_url = url_for('user', username=username, page=posts.next_num) if posts.has_next else None
     prev_url = url_for('user', username=username, page=posts.prev_num) if posts.has_prev else None
     form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts.items, form=form, next_url=next_url, prev_url=prev_url)
+    # counts are worked out here rather than in the template so the async views can reuse it (see asgi.py)
+    return render_template('user.html', user=user, posts=posts.items, form=form, next_url=next_url, prev_url=prev_url,
+                           followers_count=user.followers.count(), followed_count=user.followed.count(),
+                           is_following=current_user.is_following(user))
 
 
 # flask feature to trigger function when any request is despatched to a view function by an authenticated user.
@@ -153,6 +159,28 @@ def before_request():
         db.session.commit()
 
 
+# applies the Cache-Control policy configured for the endpoint and adds an ETag, so unchanged pages
+# are answered with '304 Not Modified' instead of being rendered and sent again
+@app.after_request
+def after_request(response):
+    endpoint = request.endpoint or ''
+    # blueprints' static files (e.g. flask_bootstrap's 'bootstrap.static') share the 'static' policy
+    if endpoint.endswith('.static'):
+        endpoint = 'static'
+    policy = app.config['CACHE_CONTROL_POLICIES'].get(endpoint)
+    if policy is None:
+        return response
+    response.headers['Cache-Control'] = policy
+    # pages rendered for a logged-in user differ for each session cookie. Public responses such
+    # as static files are the same for everyone, and shared caches should keep reusing them
+    if current_user.is_authenticated and not policy.startswith('public'):
+        response.vary.add('Cookie')
+    if request.method == 'GET' and response.status_code == 200 and not response.direct_passthrough:
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+
 @app.route('/edit_profile', methods=['POST', 'GET'])
 @login_required
 def edit_profile():
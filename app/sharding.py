@@ -0,0 +1,204 @@
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import click
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+from app import app, db
+from app.models import User, Post
+
+# Optional horizontal sharding of the post table. When POST_SHARDS lists database urls, posts
+# are stored in shard 'user_id % len(POST_SHARDS)' instead of the main database: a user's
+# profile reads a single shard, while the home and explore feeds query every shard involved at
+# once and merge the results by timestamp. Users and followers stay in the main database.
+#
+# Try it locally with:
+#   export POST_SHARDS=sqlite:///shard0.db,sqlite:///shard1.db
+#   flask shards create
+#   flask shards rebalance --include-main    # move existing posts out of the main database
+#
+# The views don't use this module directly but go through feeds.py.
+
+# the post table as created on each shard. Same as Post.__table__ but without the foreign key,
+# as the user table lives in the main database
+shard_metadata = sa.MetaData()
+shard_post_table = sa.Table(
+    'post', shard_metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('body', sa.String(140)),
+    sa.Column('timestamp', sa.DateTime, index=True),
+    sa.Column('user_id', sa.Integer, index=True),
+)
+
+
+# stands in for flask_sqlalchemy's Pagination object when posts come from the shards or the archive
+class PostPage(object):
+    def __init__(self, items, page, per_page, total):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.page * self.per_page < self.total
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next else None
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev else None
+
+
+class ShardRouter(object):
+    def __init__(self, uris, engine_options=None):
+        self.engines = [sa.create_engine(uri, **(engine_options or {})) for uri in uris]
+        self.executor = ThreadPoolExecutor(max_workers=len(self.engines)) if self.engines else None
+
+    @property
+    def enabled(self):
+        return bool(self.engines)
+
+    def shard_for(self, user_id):
+        return user_id % len(self.engines)
+
+    def session(self, shard):
+        return Session(self.engines[shard], expire_on_commit=False)
+
+    def create_tables(self):
+        for engine in self.engines:
+            shard_metadata.create_all(engine)
+
+    def add(self, post):
+        with self.session(self.shard_for(post.user_id)) as session:
+            session.add(post)
+            session.commit()
+
+    # one page of posts by the given users (or by everyone if user_ids is None), newest first.
+    # The shards are counted first, so a page past the end (e.g. one feeds.py fills from the
+    # archive) loads no posts at all. Otherwise each shard returns its newest page * per_page
+    # posts, which is enough for the merge to produce the requested page. Like
+    # paginate(error_out=False), pages before the first are page 1
+    def paginate(self, user_ids, page, per_page):
+        page = max(page, 1)
+        if user_ids is None:
+            targets = {shard: None for shard in range(len(self.engines))}
+        else:
+            targets = {}
+            for user_id in user_ids:
+                targets.setdefault(self.shard_for(user_id), []).append(user_id)
+
+        def shard_query(session, shard):
+            query = session.query(Post)
+            if targets[shard] is not None:
+                query = query.filter(Post.user_id.in_(targets[shard]))
+            return query
+
+        def count_shard(shard):
+            with self.session(shard) as session:
+                return shard_query(session, shard).count()
+
+        def fetch_shard(shard):
+            with self.session(shard) as session:
+                return shard_query(session, shard).order_by(Post.timestamp.desc()).limit(page * per_page).all()
+
+        totals = self.map(count_shard, targets)
+        total = sum(totals)
+        if (page - 1) * per_page >= total:
+            return PostPage([], page, per_page, total)
+        # shards without posts for these users have nothing to merge
+        shards = [shard for shard, count in zip(targets, totals) if count]
+        merged = heapq.merge(*self.map(fetch_shard, shards), key=lambda post: post.timestamp, reverse=True)
+        items = list(islice(merged, (page - 1) * per_page, page * per_page))
+        attach_authors(items)
+        return PostPage(items, page, per_page, total)
+
+    # runs fn for each shard, through the pool unless there is a single shard (e.g. a user's profile)
+    def map(self, fn, shards):
+        shards = list(shards)
+        if len(shards) == 1:
+            return [fn(shards[0])]
+        return list(self.executor.map(fn, shards))
+
+
+# posts loaded from a shard can't lazy load their author from the main database,
+# so load all the authors of a page at once and attach them
+def attach_authors(posts):
+    user_ids = {post.user_id for post in posts}
+    authors = {user.id: user for user in User.query.filter(User.id.in_(user_ids))} if user_ids else {}
+    for post in posts:
+        set_committed_value(post, 'author', authors.get(post.user_id))
+
+
+shards = ShardRouter(app.config['POST_SHARDS'])
+
+
+# Moves every post that is not on the shard its user_id maps to (e.g. after adding a shard),
+# batch_size posts at a time. With include_main, posts still in the main database are moved
+# too. A batch is copied and committed before it is deleted from the source, and posts that
+# already exist on the target are not copied again, so an interrupted run can simply be repeated.
+# Post ids are not kept: each shard numbers its own posts. Returns the number of posts moved.
+def rebalance(router, include_main=False, batch_size=1000):
+    sources = list(enumerate(router.engines))
+    if include_main:
+        sources.append((None, db.engine))
+    moved = 0
+    for source, engine in sources:
+        table = shard_post_table if source is not None else Post.__table__
+        misplaced = sa.select(table).order_by(table.c.id).limit(batch_size)
+        if source is not None:
+            misplaced = misplaced.where(table.c.user_id % len(router.engines) != source)
+        while True:
+            with engine.connect() as connection:
+                rows = connection.execute(misplaced).all()
+            if not rows:
+                break
+            for shard in {router.shard_for(row.user_id) for row in rows}:
+                copy_posts(router.engines[shard], [row for row in rows if router.shard_for(row.user_id) == shard])
+            with engine.begin() as connection:
+                connection.execute(table.delete().where(table.c.id.in_([row.id for row in rows])))
+            moved += len(rows)
+    return moved
+
+
+def copy_posts(engine, rows):
+    with engine.begin() as connection:
+        for row in rows:
+            exists = connection.execute(sa.select(shard_post_table.c.id).where(
+                shard_post_table.c.user_id == row.user_id, shard_post_table.c.timestamp == row.timestamp,
+                shard_post_table.c.body == row.body)).first()
+            if exists is None:
+                connection.execute(shard_post_table.insert().values(
+                    body=row.body, timestamp=row.timestamp, user_id=row.user_id))
+
+
+@app.cli.group('shards')
+def shards_cli():
+    """Manage the post shards listed in POST_SHARDS."""
+    if not shards.enabled:
+        raise click.UsageError('POST_SHARDS is not set.')
+
+
+@shards_cli.command('create')
+def create_command():
+    """Create the post table on every shard."""
+    shards.create_tables()
+    click.echo(f'Created post tables on {len(shards.engines)} shards.')
+
+
+@shards_cli.command('rebalance')
+@click.option('--include-main', is_flag=True, help='Also move posts out of the main database.')
+@click.option('--batch-size', default=1000, show_default=True)
+def rebalance_command(include_main, batch_size):
+    """Move posts to the shard their user maps to."""
+    shards.create_tables()
+    moved = rebalance(shards, include_main=include_main, batch_size=batch_size)
+    click.echo(f'Moved {moved} posts.')
@@ -0,0 +1,119 @@
+# Compares the throughput of the feed pages under concurrent requests when served by the normal
+# WSGI app (a pool of worker threads) and by the async ASGI app in microblog_asgi.py.
+#
+#   python benchmarks/feed_throughput.py --concurrency 32 --requests 500
+#
+# Both apps run in-process against the same seeded SQLite database, so the numbers compare the
+# request handling models rather than network or server overhead.
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+directory = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+os.environ['PAGE_CACHE_VERSION_FILE'] = os.path.join(directory, 'page_cache.version')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db
+from app.models import User, Post
+from app.asgi import application
+from app.page_cache import explore_cache
+
+
+def seed(users, posts_per_user):
+    with app.app_context():
+        db.create_all()
+        accounts = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(users)]
+        db.session.add_all(accounts)
+        db.session.commit()
+        for account in accounts[1:]:
+            accounts[0].follow(account)
+        now = datetime.utcnow()
+        db.session.add_all(Post(body=f'post {n} from {account.username}', user_id=account.id,
+                                timestamp=now - timedelta(minutes=n * users + account.id))
+                           for account in accounts for n in range(posts_per_user))
+        db.session.commit()
+
+
+def session_cookie():
+    serializer = app.session_interface.get_signing_serializer(app)
+    return f"{app.config['SESSION_COOKIE_NAME']}={serializer.dumps({'_user_id': '1', '_fresh': True})}"
+
+
+def request_paths(total, users):
+    paths = ['/index', '/explore', '/user/user{}']
+    return [paths[i % len(paths)].format(i % users) + f'?page={i % 5 + 1}' for i in range(total)]
+
+
+def run_wsgi(paths, concurrency, cookie):
+    def get(path):
+        return app.test_client(use_cookies=False).get(path, headers={'Cookie': cookie}).status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        statuses = list(executor.map(get, paths))
+    return time.perf_counter() - start, statuses
+
+
+async def asgi_get(path, cookie):
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'http_version': '1.1', 'method': 'GET', 'scheme': 'http', 'path': path,
+             'root_path': '', 'query_string': query.encode(), 'server': ('localhost', 80),
+             'client': ('127.0.0.1', 0), 'headers': [(b'host', b'localhost'), (b'cookie', cookie.encode())]}
+    status = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+
+    await application(scope, receive, send)
+    return status[0]
+
+
+async def run_asgi(paths, concurrency, cookie):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def get(path):
+        async with semaphore:
+            return await asgi_get(path, cookie)
+
+    start = time.perf_counter()
+    statuses = await asyncio.gather(*(get(path) for path in paths))
+    return time.perf_counter() - start, statuses
+
+
+def report(name, elapsed, statuses):
+    errors = sum(1 for status in statuses if status != 200)
+    print(f'{name:<5} {len(statuses):>6} requests in {elapsed:7.2f}s  '
+          f'{len(statuses) / elapsed:8.1f} req/s  {errors} non-200')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--posts-per-user', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+
+    seed(args.users, args.posts_per_user)
+    cookie = session_cookie()
+    paths = request_paths(args.requests, args.users)
+    print(f'{args.users} users, {args.users * args.posts_per_user} posts, concurrency {args.concurrency}')
+    # both apps share the explore page cache, so each run starts with it empty
+    explore_cache.bump()
+    report('WSGI', *run_wsgi(paths, args.concurrency, cookie))
+    explore_cache.bump()
+    report('ASGI', *asyncio.run(run_asgi(paths, args.concurrency, cookie)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# Adds a column with a default value and an index to a large seeded 'post' table in three ways,
+# while a second connection keeps inserting posts, and reports how long those inserts were blocked:
+#
+#   single      add_column, one UPDATE of every row and create_index in one transaction
+#   batch       the same through batch_alter_table(recreate='always'), which copies the table
+#   online      add_column, backfill() and create_index() from app/online_migrations.py
+#
+#   python benchmarks/migration_backfill.py --posts 1000000 --batch-size 5000
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import online_migrations
+
+metadata = sa.MetaData()
+post = sa.Table(
+    'post', metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('body', sa.String(140)),
+    sa.Column('timestamp', sa.DateTime, index=True),
+    sa.Column('user_id', sa.Integer),
+)
+
+
+def seed(engine, posts):
+    metadata.create_all(engine)
+    now = datetime.utcnow()
+    with engine.begin() as connection:
+        for start in range(0, posts, 50000):
+            connection.execute(post.insert(), [
+                {'body': f'post {n}', 'timestamp': now - timedelta(seconds=n), 'user_id': n % 1000}
+                for n in range(start, min(start + 50000, posts))])
+
+
+def migrate_single(op, batch_size):
+    op.add_column('post', sa.Column('language', sa.String(5)))
+    op.execute(sa.text("UPDATE post SET language = 'en'"))
+    op.create_index('ix_post_language', 'post', ['language'])
+
+
+def migrate_batch(op, batch_size):
+    with op.batch_alter_table('post', recreate='always') as batch_op:
+        batch_op.add_column(sa.Column('language', sa.String(5)))
+        batch_op.create_index('ix_post_language', ['language'])
+    op.execute(sa.text("UPDATE post SET language = 'en'"))
+
+
+def migrate_online(op, batch_size):
+    online_migrations.add_column('post', sa.Column('language', sa.String(5)))
+    online_migrations.backfill('post', {'language': 'en'}, batch_size=batch_size)
+    online_migrations.create_index('ix_post_language', 'post', ['language'])
+
+
+# keep inserting posts from another connection, recording how long each insert took
+def writer(engine, stop, latencies):
+    while not stop.is_set():
+        start = time.perf_counter()
+        with engine.begin() as connection:
+            connection.execute(post.insert().values(body='new post', timestamp=datetime.utcnow(), user_id=1))
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.01)
+
+
+def run(name, migration, posts, batch_size):
+    path = os.path.join(tempfile.mkdtemp(), f'{name}.db')
+    engine = sa.create_engine('sqlite:///' + path, connect_args={'timeout': 600})
+    seed(engine, posts)
+
+    stop = threading.Event()
+    latencies = []
+    thread = threading.Thread(target=writer, args=(engine, stop, latencies))
+    thread.start()
+    start = time.perf_counter()
+    try:
+        with engine.connect() as connection:
+            context = MigrationContext.configure(connection)
+            # the same transaction alembic opens around each revision script
+            with Operations.context(context), context.begin_transaction(_per_migration=True):
+                from alembic import op
+                migration(op, batch_size)
+        elapsed = time.perf_counter() - start
+    finally:
+        stop.set()
+        thread.join()
+        engine.dispose()
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+    print(f'{name:<7} migration {elapsed:7.2f}s  {len(latencies):>5} concurrent inserts  '
+          f'p99 {p99 * 1000:8.1f}ms  max {max(latencies, default=0) * 1000:8.1f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type=int, default=500000)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    args = parser.parse_args()
+
+    print(f'{args.posts} posts, backfill batch size {args.batch_size}')
+    for name, migration in (('single', migrate_single), ('batch', migrate_batch), ('online', migrate_online)):
+        run(name, migration, args.posts, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,28 @@
 import os
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+# async driver for each database, used to derive ASYNC_DATABASE_URL from DATABASE_URL
+ASYNC_DRIVERS = {'sqlite': 'aiosqlite', 'postgresql': 'asyncpg', 'postgres': 'asyncpg', 'mysql': 'aiomysql'}
+
+
+def async_database_url(url):
+    scheme, rest = url.split('://', 1)
+    dialect = scheme.split('+')[0]
+    if dialect not in ASYNC_DRIVERS:
+        return url
+    return f"{'postgresql' if dialect == 'postgres' else dialect}+{ASYNC_DRIVERS[dialect]}://{rest}"
+
+
 class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
 
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # comma separated database urls to spread the post table across, see app/sharding.py
+    POST_SHARDS = [uri for uri in (os.environ.get('POST_SHARDS') or '').split(',') if uri]
+    # same database through an async driver, used by the async feed views when running under ASGI
+    # (see microblog_asgi.py). Only needs setting if the driver can't be derived from DATABASE_URL
+    ASYNC_DATABASE_URL = os.environ.get('ASYNC_DATABASE_URL') or async_database_url(SQLALCHEMY_DATABASE_URI)
 
     # configure email server to send messages when errors/issues occur
 
@@ -17,4 +34,38 @@ class Config(object):
     ADMINS = ['ben.crawley@tvsscs.com']
 
     POSTS_PER_PAGE = 3
+    EXPLORE_CACHE_PAGES = 50  # rendered explore pages kept in memory
+    EXPLORE_CACHE_TTL = int(os.environ.get('EXPLORE_CACHE_TTL') or 60)  # seconds
+    # shared by every worker process to invalidate their page caches, see app/page_cache.py
+    PAGE_CACHE_VERSION_FILE = os.environ.get('PAGE_CACHE_VERSION_FILE') or \
+        os.path.join(basedir, 'page_cache.version')
+
+    # old posts are moved to compressed monthly files by 'flask archive run', see app/archive.py
+    ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR') or os.path.join(basedir, 'archive')
+    ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS') or 365)
+
+    # batched backfills in migrations, see app/online_migrations.py
+    MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE') or 1000)
+    MIGRATION_BATCH_THROTTLE = float(os.environ.get('MIGRATION_BATCH_THROTTLE') or 0)  # seconds between batches
+
+    # responsive image variants generated by 'flask build-images'
+    IMAGE_BUILD_DIR = os.path.join(basedir, 'app', 'images', 'build')
+    IMAGE_WIDTHS = [320, 640, 1024]
+    IMAGE_FORMATS = ['webp', 'png']
+    IMAGE_QUALITY = 80
+    IMAGE_CACHE_MAX_AGE = 31536000  # one year
+
+    # response compression, see app/compression.py
+    COMPRESS_MIN_SIZE = 500  # bytes
+    COMPRESS_LEVEL = 6
+    COMPRESS_CACHE_SIZE = 128  # compressed static files kept in memory
+    COMPRESS_REPORT_EVERY = 1000  # log the bytes saved every this many compressed responses
 
+    # Cache-Control policy for each endpoint. Pages showing the logged-in user must stay private;
+    # 'no-cache' makes browsers revalidate with the page's ETag instead of re-downloading it
+    CACHE_CONTROL_POLICIES = {
+        'index': 'private, no-cache',
+        'explore': 'private, no-cache',
+        'user': 'private, no-cache',
+        'static': 'public, max-age=86400',
+    }
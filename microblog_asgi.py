@@ -0,0 +1,5 @@
+# opt-in ASGI entry point: the feed pages are served with async database access and everything else
+# by the normal Flask app, e.g.
+#   uvicorn microblog_asgi:application --workers 2
+# (needs the asgiref and aiosqlite packages)
+from app.asgi import application
@@ -45,6 +45,12 @@ target_db = current_app.extensions['migrate'].db
 # ... etc.
 
 
+# tables created outside the models, which autogenerate must not try to drop
+def include_object(object, name, type_, reflected, compare_to):
+    from app.online_migrations import checkpoints
+    return not (type_ == 'table' and name == checkpoints.name)
+
+
 def get_metadata():
     if hasattr(target_db, 'metadatas'):
         return target_db.metadatas[None]
@@ -97,6 +103,10 @@ def run_migrations_online():
             connection=connection,
             target_metadata=get_metadata(),
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
+            # commit after every revision rather than once at the end, so a long upgrade does not
+            # hold one write lock throughout and a failure only rolls back the revision that failed
+            transaction_per_migration=True,
             **current_app.extensions['migrate'].configure_args
         )
 
@@ -1,10 +1,29 @@
 import os
+import tempfile
 
 os.environ['DATABASE_URL'] = 'sqlite://'
+os.environ['ARCHIVE_DIR'] = os.path.join(tempfile.gettempdir(), 'microblog_test_archive')
+os.environ['PAGE_CACHE_VERSION_FILE'] = os.path.join(tempfile.gettempdir(), 'microblog_test_page_cache.version')
 
 import unittest
+import asyncio
+import gzip
+import json
+import shutil
+import threading
+from unittest import mock
 from datetime import datetime, timedelta
-from app import app, db
+import sqlalchemy as sa
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from config import async_database_url
+from app import app, db, assets, online_migrations, sharding, feeds, asgi
+from app import archive as archive_module
+from app.archive import PostArchive, archive, archive_posts
+from app.compression import CompressionMiddleware
+from app.page_cache import PageCache, explore_cache
 from app.models import User, Post
 
 
@@ -91,6 +110,691 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_explore_cache_invalidation(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        version = explore_cache.version
+        renders = []
+        render = lambda: renders.append(1) or 'page 1'
+        self.assertEqual(explore_cache.get_or_render(1, render), 'page 1')
+        self.assertEqual(explore_cache.get_or_render(1, render), 'page 1')
+        self.assertEqual(len(renders), 1)
+
+        # editing the user without renaming them leaves the cache alone
+        u.about_me = 'hello'
+        db.session.commit()
+        self.assertEqual(explore_cache.version, version)
+
+        # a new post is only visible on the explore page once committed
+        db.session.add(Post(body='post from john', author=u))
+        db.session.flush()
+        self.assertEqual(explore_cache.version, version)
+        db.session.commit()
+        self.assertNotEqual(explore_cache.version, version)
+        explore_cache.get_or_render(1, render)
+        self.assertEqual(len(renders), 2)
+
+    def test_page_cache_shared_version(self):
+        with tempfile.TemporaryDirectory() as directory:
+            version_file = os.path.join(directory, 'page_cache.version')
+            # two worker processes sharing the version file
+            worker_a = PageCache(max_entries=10, version_file=version_file)
+            worker_b = PageCache(max_entries=10, version_file=version_file)
+            self.assertEqual(worker_a.get_or_render(1, lambda: 'old'), 'old')
+            self.assertEqual(worker_b.get_or_render(1, lambda: 'old'), 'old')
+            self.assertEqual(worker_b.get_or_render(1, lambda: 'new'), 'old')
+            # a post made through worker A invalidates worker B too
+            worker_a.bump()
+            self.assertEqual(worker_b.get_or_render(1, lambda: 'new'), 'new')
+            self.assertEqual(worker_a.get_or_render(1, lambda: 'new'), 'new')
+
+            # posts committed at the same moment by several threads of one worker
+            errors = []
+
+            def bump_repeatedly():
+                try:
+                    for _ in range(200):
+                        worker_a.bump()
+                except OSError as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=bump_repeatedly) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(os.listdir(directory), ['page_cache.version'])
+
+            # entries expire after the ttl even without a bump
+            worker_c = PageCache(max_entries=10, version_file=version_file, ttl=0)
+            worker_c.get_or_render(1, lambda: 'old')
+            self.assertEqual(worker_c.get_or_render(1, lambda: 'new'), 'new')
+
+
+class ImageAssetsCase(unittest.TestCase):
+    def setUp(self):
+        self.build_dir = tempfile.TemporaryDirectory()
+        self.original_build_dir = app.config['IMAGE_BUILD_DIR']
+        app.config['IMAGE_BUILD_DIR'] = self.build_dir.name
+        manifest = {'HSE Polar Icon.png': {'width': 1024, 'height': 1024, 'variants': {
+            'webp': {'320': 'hse-polar-icon-320.0123456789.webp', '1024': 'hse-polar-icon-1024.abcdefabcd.webp'},
+            'png': {'320': 'hse-polar-icon-320.9876543210.png', '1024': 'hse-polar-icon-1024.fedcbafedc.png'}}}}
+        with open(assets.manifest_path(), 'w') as f:
+            json.dump(manifest, f)
+        with open(os.path.join(self.build_dir.name, 'hse-polar-icon-320.0123456789.webp'), 'wb') as f:
+            f.write(b'RIFF')
+        assets.reset_manifest()
+        self.request_context = app.test_request_context()
+        self.request_context.push()
+
+    def tearDown(self):
+        self.request_context.pop()
+        app.config['IMAGE_BUILD_DIR'] = self.original_build_dir
+        assets.reset_manifest()
+        self.build_dir.cleanup()
+
+    def test_target_widths(self):
+        self.assertEqual(assets.target_widths(1024, [320, 640, 1280]), [320, 640, 1024])
+        self.assertEqual(assets.target_widths(200, [320, 640]), [200])
+
+    def test_image_url(self):
+        self.assertEqual(assets.image_url('HSE Polar Icon.png', 300), '/images/hse-polar-icon-320.9876543210.png')
+        self.assertEqual(assets.image_url('HSE Polar Icon.png'), '/images/hse-polar-icon-1024.fedcbafedc.png')
+        # images that have not been built fall back to the original
+        self.assertEqual(assets.image_url('HSE Panda Icon.png'), '/images/HSE%20Panda%20Icon.png')
+
+    def test_image_srcset(self):
+        self.assertEqual(assets.image_srcset('HSE Polar Icon.png'),
+                         '/images/hse-polar-icon-320.0123456789.webp 320w, '
+                         '/images/hse-polar-icon-1024.abcdefabcd.webp 1024w')
+        self.assertEqual(assets.image_srcset('HSE Panda Icon.png'), '')
+
+    def test_hashed_images_are_immutable(self):
+        response = app.test_client().get('/images/hse-polar-icon-320.0123456789.webp')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+
+    def test_build_images(self):
+        from PIL import Image
+
+        with tempfile.TemporaryDirectory() as source_dir, tempfile.TemporaryDirectory() as build_dir:
+            Image.new('RGBA', (800, 400), (255, 0, 0, 128)).save(os.path.join(source_dir, 'Red Banner.png'))
+            Image.new('RGB', (200, 100), (0, 0, 255)).save(os.path.join(source_dir, 'small.png'))
+            manifest = assets.build_images(source_dir, build_dir, [320, 640, 1024], ['webp', 'png'], 80)
+
+            entry = manifest['Red Banner.png']
+            self.assertEqual((entry['width'], entry['height']), (800, 400))
+            # never upscaled past the original width
+            self.assertEqual(sorted(entry['variants']['webp'], key=int), ['320', '640', '800'])
+            self.assertEqual(list(manifest['small.png']['variants']['png']), ['200'])
+            for fmt, variants in entry['variants'].items():
+                for width, name in variants.items():
+                    self.assertRegex(name, rf'^red-banner-{width}\.[0-9a-f]{{10}}\.{fmt}$')
+                    with Image.open(os.path.join(build_dir, name)) as image:
+                        self.assertEqual(image.format, fmt.upper())
+                        self.assertEqual(image.size, (int(width), int(width) // 2))
+            with open(os.path.join(build_dir, assets.MANIFEST_NAME)) as f:
+                self.assertEqual(json.load(f), manifest)
+
+            # the same images produce the same names, a changed image a new one
+            self.assertEqual(assets.build_images(source_dir, build_dir, [320, 640, 1024], ['webp', 'png'], 80),
+                             manifest)
+            Image.new('RGB', (200, 100), (0, 255, 0)).save(os.path.join(source_dir, 'small.png'))
+            rebuilt = assets.build_images(source_dir, build_dir, [320, 640, 1024], ['webp', 'png'], 80)
+            self.assertNotEqual(rebuilt['small.png'], manifest['small.png'])
+            self.assertEqual(rebuilt['Red Banner.png'], entry)
+
+    def test_manifest_built_later(self):
+        os.remove(assets.manifest_path())
+        self.assertEqual(assets.image_url('HSE Polar Icon.png'), '/images/HSE%20Polar%20Icon.png')
+        # 'flask build-images' run while the server is up
+        with open(assets.manifest_path(), 'w') as f:
+            json.dump({'HSE Polar Icon.png': {'width': 320, 'height': 320, 'variants': {
+                'png': {'320': 'hse-polar-icon-320.9876543210.png'}}}}, f)
+        self.assertEqual(assets.image_url('HSE Polar Icon.png'), '/images/hse-polar-icon-320.9876543210.png')
+
+
+class CompressionCase(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_gzip(self):
+        response = self.client.get('/login', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertIn(b'Sign In', gzip.decompress(response.data))
+
+    def test_identity(self):
+        response = self.client.get('/login', headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn(b'Sign In', response.data)
+
+    def test_bytes_saved(self):
+        middleware = app.wsgi_app
+        url = '/static/bootstrap/css/bootstrap.min.css'
+        saved = middleware.bytes_saved
+        response = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        first = middleware.bytes_saved - saved
+        self.assertGreater(first, 0)
+        # a response served from the compressed static cache is counted too
+        self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(middleware.bytes_saved - saved, 2 * first)
+        response.close()
+
+    def test_static_cache_control(self):
+        response = self.client.get('/static/bootstrap/css/bootstrap.min.css')
+        self.assertEqual(response.headers['Cache-Control'], app.config['CACHE_CONTROL_POLICIES']['static'])
+        response.close()
+
+    def test_streamed_response(self):
+        finished = []
+
+        def events():
+            yield b'data: first\n\n' * 100
+            finished.append(True)
+            yield b'data: second\n\n'
+
+        def stream(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/event-stream')])
+            return events()
+
+        headers = []
+        middleware = CompressionMiddleware(stream)
+        body = middleware({'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': 'gzip'},
+                          lambda status, response_headers, exc_info=None: headers.extend(response_headers))
+        # chunks are passed on as they are produced, uncompressed
+        self.assertEqual(next(iter(body)), b'data: first\n\n' * 100)
+        self.assertEqual(finished, [])
+        self.assertEqual(headers, [('Content-Type', 'text/event-stream')])
+
+    def test_negotiate(self):
+        middleware = app.wsgi_app
+        self.assertEqual(middleware.negotiate('gzip;q=1.0, identity;q=0.5'), 'gzip')
+        self.assertIsNone(middleware.negotiate('gzip;q=0'))
+        self.assertIsNone(middleware.negotiate(''))
+
+
+class CacheHeadersCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_vary(self):
+        response = self.client.get('/user/john', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
+        self.assertEqual(response.headers['Vary'], 'Cookie, Accept-Encoding')
+        # static files are public, whoever is logged in
+        response = self.client.get('/static/bootstrap/css/bootstrap.min.css', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        response.close()
+
+    def test_not_modified(self):
+        for accept_encoding in ('identity', 'gzip'):
+            response = self.client.get('/user/john', headers={'Accept-Encoding': accept_encoding})
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers['ETag']
+            response = self.client.get('/user/john', headers={'Accept-Encoding': accept_encoding,
+                                                              'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers['ETag'], etag)
+            self.assertEqual(response.data, b'')
+
+
+class OnlineMigrationCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://', poolclass=sa.pool.StaticPool)
+        self.metadata = sa.MetaData()
+        self.post = sa.Table('post', self.metadata,
+                             sa.Column('id', sa.Integer, primary_key=True),
+                             sa.Column('language', sa.String(5)))
+        self.metadata.create_all(self.engine)
+        with self.engine.begin() as connection:
+            connection.execute(self.post.insert(), [{'language': None} for _ in range(25)])
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def migrate(self, migration):
+        with app.app_context(), self.engine.connect() as connection:
+            context = MigrationContext.configure(connection)
+            with Operations.context(context), context.begin_transaction(_per_migration=True):
+                return migration()
+
+    def languages(self):
+        with self.engine.connect() as connection:
+            return connection.execute(sa.select(self.post.c.language).order_by(self.post.c.id)).scalars().all()
+
+    def test_backfill(self):
+        updated = self.migrate(lambda: online_migrations.backfill('post', {'language': 'en'}, batch_size=10))
+        self.assertEqual(updated, 25)
+        self.assertEqual(self.languages(), ['en'] * 25)
+        # the checkpoint table is dropped once the backfill completes
+        self.assertFalse(sa.inspect(self.engine).has_table('migration_checkpoint'))
+
+    def test_interrupted_migration_resumes(self):
+        sa.Table('account', self.metadata, sa.Column('id', sa.Integer, primary_key=True)).create(self.engine)
+        with self.engine.begin() as connection:
+            connection.execute(sa.text('INSERT INTO account (id) VALUES ' + ', '.join(f'({n})' for n in range(1, 26))))
+
+        def upgrade():
+            online_migrations.add_column('account', sa.Column('language', sa.String(5)))
+            return online_migrations.backfill('account', {'language': 'en'}, batch_size=10)
+
+        # the migration is killed after its second batch
+        save_checkpoint = online_migrations.save_checkpoint
+        batches = []
+
+        def save_checkpoint_then_stop(*args):
+            save_checkpoint(*args)
+            batches.append(args)
+            if len(batches) == 2:
+                raise KeyboardInterrupt()
+
+        with mock.patch('app.online_migrations.save_checkpoint', save_checkpoint_then_stop):
+            with self.assertRaises(KeyboardInterrupt):
+                self.migrate(upgrade)
+        with self.engine.begin() as connection:
+            # a row written by the app after the backfill passed it
+            connection.execute(sa.text("UPDATE account SET language = 'fr' WHERE id = 1"))
+
+        # running the revision again carries on after the second batch
+        self.assertEqual(self.migrate(upgrade), 25)
+        with self.engine.connect() as connection:
+            languages = connection.execute(sa.text('SELECT language FROM account ORDER BY id')).scalars().all()
+        self.assertEqual(languages, ['fr'] + ['en'] * 24)
+        self.assertFalse(sa.inspect(self.engine).has_table('migration_checkpoint'))
+
+    def test_create_index(self):
+        self.migrate(lambda: online_migrations.create_index('ix_post_language', 'post', ['language']))
+        indexes = sa.inspect(self.engine).get_indexes('post')
+        self.assertEqual([index['name'] for index in indexes], ['ix_post_language'])
+
+
+class ShardingCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.original_shards = sharding.shards
+        # in-memory databases shared with the threads that query the shards
+        sharding.shards = sharding.ShardRouter(['sqlite://', 'sqlite://'], engine_options={
+            'poolclass': sa.pool.StaticPool, 'connect_args': {'check_same_thread': False}})
+        sharding.shards.create_tables()
+
+    def tearDown(self):
+        sharding.shards = self.original_shards
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def shard_bodies(self, shard):
+        with sharding.shards.engines[shard].connect() as connection:
+            return sorted(connection.execute(sa.select(sharding.shard_post_table.c.body)).scalars())
+
+    def test_feeds(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+
+        now = datetime.utcnow()
+        for n, author in enumerate([u1, u2, u3, u2, u1]):
+            sharding.shards.add(Post(body=f'post {n}', user_id=author.id, timestamp=now + timedelta(seconds=n)))
+        # posts are stored on the shard of their author
+        self.assertEqual(self.shard_bodies(0), ['post 1', 'post 3'])
+        self.assertEqual(self.shard_bodies(1), ['post 0', 'post 2', 'post 4'])
+
+        page = feeds.followed_posts_page(u1, page=1, per_page=3)
+        self.assertEqual([post.body for post in page.items], ['post 4', 'post 3', 'post 1'])
+        self.assertEqual(page.items[0].author.username, 'john')
+        self.assertTrue(page.has_next)
+        page = feeds.followed_posts_page(u1, page=2, per_page=3)
+        self.assertEqual([post.body for post in page.items], ['post 0'])
+        self.assertFalse(page.has_next)
+
+        page = feeds.all_posts_page(page=1, per_page=10)
+        self.assertEqual([post.body for post in page.items], ['post 4', 'post 3', 'post 2', 'post 1', 'post 0'])
+        page = feeds.user_posts_page(u2, page=1, per_page=10)
+        self.assertEqual([post.body for post in page.items], ['post 3', 'post 1'])
+        # pages before the first are served as page 1
+        for number in (0, -1):
+            page = feeds.all_posts_page(page=number, per_page=3)
+            self.assertEqual([post.body for post in page.items], ['post 4', 'post 3', 'post 2'])
+            self.assertEqual(page.next_num, 2)
+
+    def test_page_past_the_end(self):
+        u1 = User(username='john', email='john@example.com')
+        db.session.add(u1)
+        db.session.commit()
+        for n in range(5):
+            sharding.shards.add(Post(body=f'post {n}', user_id=u1.id))
+        statements = []
+        for engine in sharding.shards.engines:
+            sa.event.listen(engine, 'before_cursor_execute',
+                            lambda conn, cursor, statement, *args: statements.append(statement))
+
+        page = sharding.shards.paginate(None, page=3, per_page=3)
+        self.assertEqual((page.items, page.total, page.has_next), ([], 5, False))
+        # only the shards were counted, no posts were loaded
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(all('count(' in statement for statement in statements))
+
+        page = sharding.shards.paginate(None, page=2, per_page=3)
+        self.assertEqual([post.body for post in page.items], ['post 1', 'post 0'])
+        # the shard without posts is not queried for them
+        self.assertEqual(len(statements), 5)
+
+    def test_rebalance(self):
+        u1 = User(username='john', email='john@example.com')
+        db.session.add(u1)
+        db.session.add(Post(body='post from main', author=u1))
+        db.session.commit()
+        # misplaced on shard 0, user 1 belongs on shard 1
+        with sharding.shards.engines[0].begin() as connection:
+            connection.execute(sharding.shard_post_table.insert().values(
+                body='misplaced post', user_id=u1.id, timestamp=datetime.utcnow()))
+
+        moved = sharding.rebalance(sharding.shards, include_main=True)
+        self.assertEqual(moved, 2)
+        self.assertEqual(self.shard_bodies(0), [])
+        self.assertEqual(self.shard_bodies(1), ['misplaced post', 'post from main'])
+        self.assertEqual(Post.query.count(), 0)
+
+
+class ArchiveCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.u1, self.u2])
+        # one post a day for ten days, alternating between the two users
+        now = datetime.utcnow()
+        for n in range(10):
+            db.session.add(Post(body=f'post {n}', author=[self.u1, self.u2][n % 2],
+                                timestamp=now - timedelta(days=n, hours=1)))
+        db.session.commit()
+
+    def tearDown(self):
+        shutil.rmtree(app.config['ARCHIVE_DIR'], ignore_errors=True)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def bodies(self, page):
+        return [post.body for post in page.items]
+
+    def test_archive_posts(self):
+        archived = archive_posts(datetime.utcnow() - timedelta(days=4), batch_size=2)
+        self.assertEqual(archived, 6)
+        self.assertEqual(Post.query.count(), 4)
+        self.assertEqual(archive.count(), 6)
+        self.assertEqual(archive.count([self.u1.id]), 3)
+
+    def test_read_through(self):
+        archive_posts(datetime.utcnow() - timedelta(days=4))
+        # page 2 starts in the database and carries on into the archive
+        page = feeds.all_posts_page(page=2, per_page=3)
+        self.assertEqual(self.bodies(page), ['post 3', 'post 4', 'post 5'])
+        self.assertEqual(page.items[1].author.username, 'john')
+        page = feeds.all_posts_page(page=4, per_page=3)
+        self.assertEqual(self.bodies(page), ['post 9'])
+        self.assertFalse(page.has_next)
+
+        page = feeds.user_posts_page(self.u2, page=1, per_page=4)
+        self.assertEqual(self.bodies(page), ['post 1', 'post 3', 'post 5', 'post 7'])
+        self.assertTrue(page.has_next)
+        page = feeds.followed_posts_page(self.u1, page=2, per_page=2)
+        self.assertEqual(self.bodies(page), ['post 4', 'post 6'])
+
+    def test_compact(self):
+        archive_posts(datetime.utcnow() - timedelta(days=4))
+        # archive the same posts again, as an interrupted run would
+        segment = next(iter(archive.index().values()))
+        rows = [Post(id=row['id'], body=row['body'], user_id=row['user_id'],
+                     timestamp=datetime.strptime(row['timestamp'], '%Y-%m-%dT%H:%M:%S.%f'))
+                for row in archive.read_segment(segment)]
+        archive.append(rows)
+        self.assertEqual(archive.count(), 6 + len(rows))
+        self.assertEqual(archive.compact(), len(rows))
+        self.assertEqual(archive.count(), 6)
+        self.assertEqual(self.bodies(feeds.all_posts_page(page=1, per_page=10)),
+                         [f'post {n}' for n in range(10)])
+
+    def test_read_during_append(self):
+        archive_posts(datetime.utcnow() - timedelta(days=4))
+        expected = self.bodies(feeds.all_posts_page(page=2, per_page=3))
+        month, entry = max(archive.index().items())
+        # an append in progress: one complete gzip member the index doesn't count yet, then a partial one
+        member = gzip.compress(json.dumps({'id': 1000, 'body': 'not indexed yet', 'user_id': self.u1.id,
+                                           'timestamp': entry['newest']}).encode('utf-8') + b'\n')
+        with open(archive.path(entry['file']), 'ab') as f:
+            f.write(member + member[:len(member) // 2])
+        archive_module.load_segment.cache_clear()
+        self.assertEqual(self.bodies(feeds.all_posts_page(page=2, per_page=3)), expected)
+        self.assertEqual(archive.count(), 6)
+
+        # the next append replaces what the interrupted one left behind
+        archive.append([Post(id=1001, body='appended', user_id=self.u1.id,
+                             timestamp=datetime.strptime(entry['newest'], '%Y-%m-%dT%H:%M:%S.%f'))])
+        bodies = [row['body'] for row in archive_module.read_rows(archive.path(entry['file']))]
+        self.assertEqual(len(bodies), archive.index()[month]['count'])
+        self.assertIn('appended', bodies)
+        self.assertNotIn('not indexed yet', bodies)
+
+    def test_read_during_compact(self):
+        archive_posts(datetime.utcnow() - timedelta(days=4))
+        reader = PostArchive(app.config['ARCHIVE_DIR'])
+        old_index = reader.index()
+        compactor = PostArchive(app.config['ARCHIVE_DIR'])
+        compactor.compact()
+        # a request that read the index before the compaction finds its segments gone and
+        # reads them again through the new index
+        self.assertFalse(any(os.path.exists(reader.path(entry['file'])) for entry in old_index.values()))
+        with mock.patch.object(reader, 'index', side_effect=[old_index, compactor.index()]):
+            posts = reader.posts(None, 0, 10)
+        self.assertEqual(len(posts), 6)
+
+    def test_append_during_compact(self):
+        archive_posts(datetime.utcnow() - timedelta(days=4))
+        # the first segment compact() reads
+        month = min(archive.index())
+        # 'archive run' and 'archive compact' as two processes sharing the directory
+        runner = PostArchive(app.config['ARCHIVE_DIR'])
+        compactor = PostArchive(app.config['ARCHIVE_DIR'])
+        new_post = Post(id=1000, body='archived during compact', user_id=self.u1.id,
+                        timestamp=datetime.strptime(archive.index()[month]['newest'], '%Y-%m-%dT%H:%M:%S.%f'))
+        appender = threading.Thread(target=runner.append, args=([new_post],))
+        read_rows = archive_module.read_rows
+
+        # start the append once compact has read the segment, before it writes it back
+        def read_rows_during_append(path, size=None):
+            rows = list(read_rows(path, size))
+            if appender.ident is None:
+                appender.start()
+                appender.join(timeout=0.2)
+            return rows
+
+        with mock.patch('app.archive.read_rows', read_rows_during_append):
+            compactor.compact()
+        appender.join()
+        self.assertEqual(archive.count(), 7)
+        segment_bodies = [row['body'] for entry in archive.index().values()
+                          for row in read_rows(archive.path(entry['file']))]
+        self.assertEqual(len(segment_bodies), 7)
+        self.assertIn('archived during compact', segment_bodies)
+
+
+class AsgiCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.u = User(username='john', email='john@example.com', last_seen=datetime(2000, 1, 1))
+        db.session.add(self.u)
+        db.session.commit()
+        explore_cache.bump()
+        # the async views read a second database, seeded by mirror() with the rows of the main one
+        self.directory = tempfile.TemporaryDirectory()
+        self.original_engine = asgi.engine, asgi.async_session
+        asgi.engine = create_async_engine('sqlite+aiosqlite:///' + os.path.join(self.directory.name, 'app.db'),
+                                          poolclass=sa.pool.NullPool)
+        asgi.async_session = sessionmaker(asgi.engine, class_=AsyncSession, expire_on_commit=False)
+
+    def tearDown(self):
+        asgi.engine, asgi.async_session = self.original_engine
+        self.directory.cleanup()
+        shutil.rmtree(app.config['ARCHIVE_DIR'], ignore_errors=True)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def mirror(self):
+        async def copy_tables():
+            async with asgi.engine.begin() as connection:
+                await connection.run_sync(db.metadata.drop_all)
+                await connection.run_sync(db.metadata.create_all)
+                for table in db.metadata.sorted_tables:
+                    rows = [row._asdict() for row in db.session.execute(table.select())]
+                    if rows:
+                        await connection.execute(table.insert(), rows)
+        asyncio.run(copy_tables())
+
+    def async_last_seen(self):
+        async def query():
+            async with asgi.engine.connect() as connection:
+                return (await connection.execute(sa.select(User.last_seen))).scalar()
+        return asyncio.run(query())
+
+    def cookie(self, **session):
+        serializer = app.session_interface.get_signing_serializer(app)
+        return f"{app.config['SESSION_COOKIE_NAME']}={serializer.dumps({'_user_id': str(self.u.id), '_fresh': True, **session})}"
+
+    # calls the ASGI application with a synthetic scope and returns the status, headers and body
+    def get(self, path, query_string=b'', cookie=None, headers=()):
+        headers = [(b'host', b'localhost')] + [(name.encode(), value.encode()) for name, value in headers]
+        if cookie is not None:
+            headers.append((b'cookie', cookie.encode()))
+        scope = {'type': 'http', 'http_version': '1.1', 'method': 'GET', 'scheme': 'http', 'path': path,
+                 'raw_path': path.encode(), 'root_path': '', 'query_string': query_string,
+                 'server': ('localhost', 80), 'client': ('127.0.0.1', 0), 'headers': headers}
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(asgi.application(scope, receive, send))
+        response_headers = {}
+        for name, value in messages[0]['headers']:
+            response_headers.setdefault(name.decode(), []).append(value.decode())
+        return messages[0]['status'], response_headers, b''.join(m.get('body', b'') for m in messages[1:])
+
+    def test_async_database_url(self):
+        self.assertEqual(async_database_url('sqlite:////srv/app.db'), 'sqlite+aiosqlite:////srv/app.db')
+        self.assertEqual(async_database_url('postgresql://user:secret@db/microblog'),
+                         'postgresql+asyncpg://user:secret@db/microblog')
+        self.assertEqual(async_database_url('mysql+pymysql://db/microblog'), 'mysql+aiomysql://db/microblog')
+        self.assertTrue(asgi.same_database('mysql+aiomysql://db/microblog', 'mysql+pymysql://db/microblog'))
+        self.assertFalse(asgi.same_database('sqlite+aiosqlite:////srv/app.db', 'postgresql://db/microblog'))
+
+    def test_anonymous_request_goes_to_wsgi(self):
+        status, headers, _ = self.get('/explore')
+        self.assertEqual(status, 302)
+        self.assertIn('/login', headers['location'][0])
+
+    def test_async_view(self):
+        self.mirror()
+        # only the async views read the second database
+        asyncio.run(self.add_async_post('post from the async database'))
+        status, headers, body = self.get('/explore', cookie=self.cookie(_flashes=[('message', 'Hello')]))
+        self.assertEqual(status, 200)
+        self.assertIn(b'post from the async database', body)
+        # the flashed message is shown and removed from the session cookie
+        self.assertIn(b'Hello', body)
+        self.assertTrue(any(cookie.startswith('session=') for cookie in headers['set-cookie']))
+        self.assertGreater(self.async_last_seen(), datetime(2000, 1, 1))
+
+    async def add_async_post(self, body, timestamp=None):
+        async with asgi.engine.begin() as connection:
+            await connection.execute(Post.__table__.insert().values(
+                body=body, user_id=self.u.id, timestamp=timestamp or datetime.utcnow()))
+
+    def test_compression(self):
+        self.mirror()
+        status, headers, body = self.get('/user/john', cookie=self.cookie(), headers=[('Accept-Encoding', 'gzip')])
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-encoding'], ['gzip'])
+        self.assertIn('Accept-Encoding', headers['vary'][0])
+        self.assertIn(b'john', gzip.decompress(body))
+        # the ETag of the compressed page revalidates
+        etag = headers['etag'][0]
+        self.assertTrue(etag.endswith('-gzip"'))
+        status, headers, _ = self.get('/user/john', cookie=self.cookie(),
+                                      headers=[('Accept-Encoding', 'gzip'), ('If-None-Match', etag)])
+        self.assertEqual(status, 304)
+        self.assertEqual(headers['etag'], [etag])
+
+    def test_page_before_first(self):
+        self.mirror()
+        now = datetime.utcnow()
+        for n in range(4):
+            asyncio.run(self.add_async_post(f'post {n}', now - timedelta(minutes=n)))
+        status, _, body = self.get('/index', query_string=b'page=0', cookie=self.cookie())
+        self.assertEqual(status, 200)
+        self.assertIn(b'post 0', body)
+        self.assertIn(b'page=2', body)
+
+    def test_error_page(self):
+        self.mirror()
+
+        async def broken_view(db_session, current):
+            raise RuntimeError('broken view')
+
+        with mock.patch.dict(asgi.ASYNC_VIEWS, {'explore': broken_view}), \
+                self.assertLogs(app.logger, level='ERROR') as logs:
+            status, _, body = self.get('/explore', cookie=self.cookie())
+        self.assertEqual(status, 500)
+        self.assertIn(b'An unexpected error has occurred', body)
+        self.assertIn('broken view', logs.output[0])
+        # abort(404) in an async view renders the 404 page
+        status, _, _ = self.get('/user/nobody', cookie=self.cookie())
+        self.assertEqual(status, 404)
+
+    def test_archive_goes_to_wsgi(self):
+        db.session.add(Post(body='archived post', author=self.u, timestamp=datetime.utcnow() - timedelta(days=10)))
+        db.session.commit()
+        self.mirror()
+        archive_posts(datetime.utcnow() - timedelta(days=5))
+        # only the WSGI app reads the main database
+        db.session.add(Post(body='post from the main database', author=self.u))
+        db.session.commit()
+        status, _, body = self.get('/index', cookie=self.cookie())
+        self.assertEqual(status, 200)
+        self.assertIn(b'post from the main database', body)
+        self.assertIn(b'archived post', body)
+
 
 if __name__ == '__main__':
     unittest.main()